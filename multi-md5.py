@@ -7,38 +7,180 @@ import hashlib
 import logging
 import os
 import sys
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import deque
+from functools import partial
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, as_completed, wait
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
 
 logging.basicConfig(format='%(levelname)s: %(message)s')
 logger = logging.getLogger(__name__)
 
+# st_blksize is usually 4 KiB, which is way too small to keep readahead (or an NVMe drive) busy
+DEFAULT_READ_SIZE = 1024 * 1024
+# checksum files (ours or anybody else's) don't get checksummed themselves; compared lower-cased
+SKIP_EXTS = frozenset({".md5", ".md5sum", ".sha256", ".sha1"})
+# files smaller than this are hashed with small plain reads; no point setting up readahead or a big buffer for them
+SMALL_FILE_SIZE = 64 * 1024
+# hand files to the workers in tasks of up to this many files / bytes, so small files don't each pay for a round trip
+# to a worker process, but a couple of big ones still get a task to themselves
+FILES_PER_TASK = 8
+BYTES_PER_TASK = 64 * 1024 * 1024
 
-def calculate_file_checksum(file_path, read_size=8192, pass_through=None):
-    """Calculate the MD5 checksum of a file."""
-    hasher = hashlib.md5()
+# an empty hasher per algorithm, per process; copying one is about 3x cheaper than hashlib.new(), which adds up on
+# trees full of tiny files
+_HASHER_TEMPLATES = {}
+
+
+def new_hasher(algo="md5"):
+    """Get a fresh hasher for algo by copying the empty template for it."""
+    template = _HASHER_TEMPLATES.get(algo)
+    if template is None:
+        template = _HASHER_TEMPLATES[algo] = hashlib.new(algo)
+    return template.copy()
+
+
+def init_worker(level):
+    """Pool initializer: workers started with spawn/forkserver don't inherit the log level main() set."""
+    logger.setLevel(level)
+
+
+def advise_kernel(fd, *advice):
+    """Pass posix_fadvise hints for the whole file, on platforms that have it (not macOS)."""
+    if not hasattr(os, "posix_fadvise"):
+        return
+    for a in advice:
+        try:
+            os.posix_fadvise(fd, 0, 0, a)
+        except OSError:
+            # it's only a hint; some filesystems and special files don't take it
+            pass
+
+
+def prefetch_files(file_paths):
+    """Ask the kernel to start reading these files into the page cache before a worker gets to them."""
+    if not hasattr(os, "posix_fadvise"):
+        return
+    for file_path in file_paths:
+        try:
+            fd = os.open(file_path, os.O_RDONLY)
+        except OSError:
+            # the worker will complain about it properly
+            continue
+        try:
+            advise_kernel(fd, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+
+
+def is_rotational(path):
+    """Guess whether path lives on a spinning disk. Only knows how to find out on Linux; anything else is 'no'."""
+    try:
+        dev = os.stat(path).st_dev
+    except OSError:
+        return False
+    sys_dev = f"/sys/dev/block/{os.major(dev)}:{os.minor(dev)}"
+    # a partition doesn't have its own queue/ directory, its parent disk does
+    for candidate in (sys_dev, os.path.join(sys_dev, "..")):
+        try:
+            with open(os.path.join(candidate, "queue", "rotational")) as f:
+                return f.read().strip() == "1"
+        except OSError:
+            continue
+    return False
+
+
+def order_batch(items, rotational=False, stat=os.stat):
+    """
+    Put a batch of files in a good order to hand to the workers.
+
+    On a spinning disk, go in inode order; inodes tend to be allocated near their data, so the head moves less.
+    Otherwise, biggest first, so the big files get started early instead of being the straggler at the end.
+    `stat` gives the os.stat_result for an item; by default items are paths and get stat'ed here.
+    """
+    def sort_key(item):
+        try:
+            st = stat(item)
+        except OSError:
+            st = None
+        if st is None:
+            # let the worker deal with it
+            return 0
+        return st.st_ino if rotational else -st.st_size
+
+    return sorted(items, key=sort_key)
+
+
+def update_from_reads(hasher, f, read_size):
+    """Feed the file to the hasher read_size bytes at a time, reusing one buffer instead of a new bytes per read."""
+    buf = bytearray(read_size)
+    view = memoryview(buf)
+    while (n := f.readinto(buf)) > 0:
+        hasher.update(view[:n])
+
+
+def calculate_file_checksum(file_path, read_size=DEFAULT_READ_SIZE, pass_through=None, algo="md5", size=None):
+    """
+    Calculate the checksum of a file (MD5 unless another algo is given).
+
+    If the caller already knows the size (from the directory walk), pass it in; small files then skip the fstat.
+    """
+    hasher = new_hasher(algo)
     try:
-        with open(file_path, 'rb') as f:
+        # unbuffered: we read straight into our own buffer, so python's buffering would just be another copy
+        with open(file_path, 'rb', buffering=0) as f:
             logger.debug(f"Processing {file_path}")
-            for chunk in iter(lambda: f.read(read_size), b""):
-                hasher.update(chunk)
+            if size is None:
+                size = os.fstat(f.fileno()).st_size
+
+            if size < SMALL_FILE_SIZE:
+                # keep going to EOF: a read can come back short (NFS, FUSE, a signal) without being the end of the file
+                while data := f.read(SMALL_FILE_SIZE):
+                    hasher.update(data)
+            else:
+                if hasattr(os, "posix_fadvise"):
+                    advise_kernel(f.fileno(), os.POSIX_FADV_SEQUENTIAL, os.POSIX_FADV_WILLNEED)
+                # plain reads, not mmap: a file truncated under a mapping means SIGBUS, which kills the worker and the pool
+                update_from_reads(hasher, f, read_size)
         return file_path, hasher.hexdigest(), pass_through
     except FileNotFoundError:
         logger.warning(f"File Not Found: {file_path}")
         return file_path, None, pass_through
 
 
+def report_lost_files(tasks):
+    """A worker process died outright (killed, out of memory...) and took the pool with it; say what never got done."""
+    for task in tasks:
+        for file_path, _, _ in task:
+            logger.error(f"Not processed, the worker pool died: {file_path}")
+
+
+def calculate_file_checksums(jobs, read_size=DEFAULT_READ_SIZE, algo="md5"):
+    """Run calculate_file_checksum over a list of (file path, pass through, size) jobs; one worker round trip for all."""
+    results = []
+    for file_path, pass_through, size in jobs:
+        try:
+            results.append(calculate_file_checksum(file_path, read_size, pass_through, algo, size))
+        except Exception as e:
+            # otherwise there's no telling which file in the task blew up
+            raise RuntimeError(f"{file_path}: {e}") from e
+    return results
+
+
 def read_checksum_file(file):
     """Read checksums from a file."""
+    checksums = []
+    # one pass; don't remove() from the list while looping over it, that skips the line after each comment
     with open(file, 'r') as f:
-        lines = f.readlines()
+        for line in f:
+            if line.startswith("#"):
+                logger.debug(f"skipping line: {line}")
+                continue
+            parts = line.split()
+            if parts:
+                checksums.append((parts[0], parts[1]))
 
-    for line in lines:
-        if line.startswith("#"):
-            logger.debug(f"skipping line: {line}")
-            lines.remove(line)
-
-    return [(line.split()[0], line.split()[1]) for line in lines]
+    return checksums
 
 
 def batch(iterable, n=1):
@@ -48,22 +190,69 @@ def batch(iterable, n=1):
         yield iterable[ndx:min(ndx + n, l)]
 
 
-def batch_os_walk(directory, batch_size=1, skip_hidden=True):
-    def is_hidden(path):
-        return any(part.startswith('.') for part in path.split(os.sep))
+def tasks(jobs, max_files=FILES_PER_TASK, max_bytes=BYTES_PER_TASK):
+    """Group (file path, pass through, size) jobs into lists of up to max_files jobs or max_bytes, whichever is first."""
+    task = []
+    task_bytes = 0
+    for job in jobs:
+        task.append(job)
+        task_bytes += job[2] or 0
+        if len(task) >= max_files or task_bytes >= max_bytes:
+            yield task
+            task = []
+            task_bytes = 0
 
-    file_batch = []
-    for root, dirs, files in os.walk(directory, followlinks=True):
+    if task:
+        yield task
 
-        if skip_hidden:
-            # Skip hidden directories
-            dirs[:] = [d for d in dirs if not d.startswith('.')]
 
-        for file in files:
-            file_path = os.path.join(root, file)
-            # Optionally skip hidden files
-            if not skip_hidden or not is_hidden(file_path):
-                file_batch.append(file_path)
+def batch_scandir(directory, batch_size=1, skip_hidden=True):
+    """
+    Walk the directory tree (following symlinks, like os.walk(followlinks=True)) and yield batches of
+    (file path, os.stat_result) tuples.
+
+    Uses os.scandir directly so the file-type checks come from the cached directory entries, and each file is
+    stat'ed once here so nothing downstream has to. Probable checksum files (see SKIP_EXTS) are dropped here so they
+    never make it into a batch.
+    """
+    file_batch = []
+    directories = deque([directory])
+    while directories:
+        try:
+            entries = os.scandir(directories.popleft())
+        except OSError as e:
+            # os.walk quietly skips directories it can't read; at least say so
+            logger.warning(f"Can't read directory: {e}")
+            continue
+
+        with entries:
+            for entry in entries:
+                # Optionally skip hidden files and directories
+                if skip_hidden and entry.name.startswith('.'):
+                    continue
+
+                try:
+                    if entry.is_dir(follow_symlinks=True):
+                        directories.append(entry.path)
+                        continue
+                    is_file = entry.is_file(follow_symlinks=True)
+                except OSError:
+                    is_file = False
+                if not is_file:
+                    logger.warning(f"Skipping {entry.path}, it isn't a regular file")
+                    continue
+
+                if os.path.splitext(entry.name)[1].lower() in SKIP_EXTS:
+                    logger.warning(f"Skipping probable checksum file {entry.path}")
+                    continue
+
+                try:
+                    st = entry.stat(follow_symlinks=True)
+                except OSError as e:
+                    logger.warning(f"Skipping {entry.path}, can't stat it: {e}")
+                    continue
+
+                file_batch.append((entry.path, st))
 
                 # If the batch size is reached, yield the batch and reset the list
                 if len(file_batch) == batch_size:
@@ -75,88 +264,169 @@ def batch_os_walk(directory, batch_size=1, skip_hidden=True):
         yield file_batch
 
 
-def calculate_checksums_multithread(directory_path, max_workers=5, read_size=8192, outfile=sys.stdout, dotslash="", skip_hidden=True):
-    """Calculate MD5 checksums for all files in the given directory."""
+def calculate_checksums_multithread(directory_path, max_workers=5, read_size=DEFAULT_READ_SIZE, outfile=sys.stdout, dotslash="", skip_hidden=True, algo="md5"):
+    """Calculate checksums for all files in the given directory. Returns how many checksum lines were written."""
 
     # totally arbitrary; let's go with a pretty big number.
     batch_size = max_workers * 20
+    # keep this many tasks in flight, topping up as each one finishes, so the workers never sit idle waiting on a batch
+    window = max_workers * 4
+    rotational = is_rotational(directory_path)
+    logger.debug(f"Spinning disk: {rotational}")
+    work = partial(calculate_file_checksums, read_size=read_size, algo=algo)
+    # everything the walk gives back starts with this, so just chop it off rather than commonpath/relpath every file
+    prefix = os.path.join(directory_path, "")
+    # collect output lines and write them in one go, instead of a write (and flush) per file
+    lines_per_write = 1024
+    pending_lines = []
+    num_written = 0
+
+    def flush_output():
+        nonlocal num_written
+        num_written += len(pending_lines)
+        outfile.write("".join(pending_lines))
+        outfile.flush()
+        pending_lines.clear()
+
+    def files_to_do():
+        for filenames in batch_scandir(directory_path, batch_size, skip_hidden=skip_hidden):
+            for filename, st in order_batch(filenames, rotational, stat=lambda item: item[1]):
+                yield filename, None, st.st_size
+
+    def write_results(done):
+        for future in done:
+            task = in_flight.pop(future)
+            try:
+                task_results = future.result()
+            except BrokenProcessPool as e:
+                report_lost_files([task, *in_flight.values()])
+                raise RuntimeError(f"Error processing file: a worker process died; see above for the files it took with it") from e
+            except Exception as e:
+                raise RuntimeError(f"Error processing file: {e}") from e
+            for file_path, calculated_checksum, _ in task_results:
+                assert file_path.startswith(prefix), f"{file_path} is not under {directory_path}"
+                shortened_path = file_path[len(prefix):]
+                line = f"{calculated_checksum}  {dotslash}{shortened_path}\n"
+                pending_lines.append(line)
+                # -v is the way to watch it go by live
+                logger.info(line[:-1])
+            if len(pending_lines) >= lines_per_write:
+                flush_output()
+
+    in_flight = {}
+    # hashing is CPU bound once the file is in the page cache, so use processes to get out from under the GIL
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=init_worker, initargs=(logger.level,)) as executor:
+        try:
+            for task in tasks(files_to_do()):
+                if len(in_flight) >= window:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    write_results(done)
+                in_flight[executor.submit(work, task)] = task
 
-    try:
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            for filenames in batch_os_walk(directory_path, batch_size, skip_hidden=skip_hidden):
-                futures = []
-                for filename in filenames:
-                    if filename.endswith(".md5") or filename.endswith(".md5sum"):
-                        logger.warning(f"Skipping probable md5 file {filename}")
-                    else:
-                        futures.append(executor.submit(calculate_file_checksum, filename, read_size, pass_through=None))
-
-                for future in as_completed(futures):
-                    try:
-                        file_path, calculated_checksum, _ = future.result()
-                        common_path = os.path.commonpath([file_path, directory_path])
-                        shortened_path = os.path.relpath(file_path, common_path)
-                        print(f"{calculated_checksum}  {dotslash}{shortened_path}", file=outfile, flush=True)
-                        logger.info(f"{calculated_checksum}  {dotslash}{shortened_path}")
-                    except Exception as e:
-                        raise RuntimeError(f"Error processing file: {e}")
-
-    except KeyboardInterrupt:
-        logger.warning("\nOperation cancelled by user. Exiting...")
-        for future in futures:
-            future.cancel()  # Cancel any pending futures
-        sys.exit(1)  # Exit with error code 1
-
-
-def verify_checksums_multithread(checksums, directory_path, max_workers=5, read_size=8192, keep_going=False):
-    results = []
+            write_results(as_completed(list(in_flight)))
 
+        except KeyboardInterrupt:
+            logger.warning("\nOperation cancelled by user. Exiting...")
+            executor.shutdown(wait=False, cancel_futures=True)  # Cancel any pending work
+            sys.exit(1)  # Exit with error code 1
+
+        finally:
+            # whatever we finished, get it into the file
+            flush_output()
+
+    return num_written
+
+
+def verify_checksums_multithread(checksums, directory_path, max_workers=5, read_size=DEFAULT_READ_SIZE, keep_going=False, algo="md5"):
+    """
+    Check files under directory_path against (expected checksum, file) pairs.
+
+    Yields (file path, calculated checksum, expected checksum) as each file finishes, rather than holding on to every
+    result until the end; a verify of millions of files would otherwise keep millions of tuples around.
+    """
     # This batch size is totally arbitrary; it could totally be a different number.
-    # I'm figuring that we want to use batches, otherwise it will submit hundreds of "executors" before processing the first few.
-    # so maybe this is faster?
+    # Files get ordered (and prefetched) a batch at a time, but handed to the workers a few at a time through a window
+    # that gets topped up as each task finishes, so we don't stall at the end of every batch.
     batch_size = max_workers * 4
+    window = max_workers * 4
+    rotational = is_rotational(directory_path)
+    logger.debug(f"Spinning disk: {rotational}")
+    work = partial(calculate_file_checksums, read_size=read_size, algo=algo)
 
-    try:
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-
-            for chunk in batch(checksums, batch_size):
-                future_to_file = {executor.submit(calculate_file_checksum, os.path.abspath(os.path.join(directory_path, file)), read_size, pass_through=expected_checksum): file for
-                                  expected_checksum, file in chunk}
-
-                for future in as_completed(future_to_file):
-                    file_path = future_to_file[future]
-                    try:
-                        file_path, calculated_checksum, expected_checksum = future.result()
-                        results.append((file_path, calculated_checksum, expected_checksum))
-                        if expected_checksum == calculated_checksum:
-                            logger.info(f"{file_path} : OK")
-                        else:
-                            logger.critical(f"{file_path} : FAILED")
-                            if not keep_going:
-                                raise ValueError(f"Invalid checksum for {file_path}, expected={expected_checksum} calculated={calculated_checksum}")
-                    except Exception as exc:
-                        raise RuntimeError(f'{file_path} generated an exception: {exc}')
-
-    except KeyboardInterrupt:
-        logger.warning("\nOperation cancelled by user. Exiting...")
-        for future in future_to_file:
-            future.cancel()  # Cancel any pending futures
-        sys.exit(1)  # Exit with error code 1
+    def stat_or_none(file_path):
+        try:
+            return os.stat(file_path)
+        except OSError:
+            # missing files get reported by the worker
+            return None
+
+    def files_to_do():
+        chunks = batch(checksums, batch_size)
+        chunk = next(chunks, None)
+        while chunk is not None:
+            to_do = []
+            for expected_checksum, file in chunk:
+                file_path = os.path.abspath(os.path.join(directory_path, file))
+                to_do.append((file_path, expected_checksum, stat_or_none(file_path)))
+            to_do = order_batch(to_do, rotational, stat=lambda item: item[2])
+
+            # get the disk going on the next batch while the workers chew on this one
+            chunk = next(chunks, None)
+            if chunk is not None:
+                prefetch_files(os.path.join(directory_path, file) for _, file in chunk)
+
+            for file_path, expected_checksum, st in to_do:
+                yield file_path, expected_checksum, st.st_size if st is not None else None
+
+    def check_results(done):
+        for future in done:
+            task = in_flight.pop(future)
+            try:
+                task_results = future.result()
+            except BrokenProcessPool as exc:
+                report_lost_files([task, *in_flight.values()])
+                raise RuntimeError(f'Error processing file: a worker process died; see above for the files it took with it') from exc
+            except Exception as exc:
+                raise RuntimeError(f'Error processing file: {exc}') from exc
+            for file_path, calculated_checksum, expected_checksum in task_results:
+                if expected_checksum == calculated_checksum:
+                    logger.info(f"{file_path} : OK")
+                else:
+                    logger.critical(f"{file_path} : FAILED")
+                    if not keep_going:
+                        raise ValueError(f"Invalid checksum for {file_path}, expected={expected_checksum} calculated={calculated_checksum}")
+                yield file_path, calculated_checksum, expected_checksum
+
+    in_flight = {}
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=init_worker, initargs=(logger.level,)) as executor:
+        try:
+            for task in tasks(files_to_do()):
+                if len(in_flight) >= window:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    yield from check_results(done)
+                in_flight[executor.submit(work, task)] = task
 
-    return results
+            yield from check_results(as_completed(list(in_flight)))
+
+        except KeyboardInterrupt:
+            logger.warning("\nOperation cancelled by user. Exiting...")
+            executor.shutdown(wait=False, cancel_futures=True)  # Cancel any pending work
+            sys.exit(1)  # Exit with error code 1
 
 
 def main():
-    parser = argparse.ArgumentParser(description="Calculate MD5 checksums for all files in a directory.")
+    parser = argparse.ArgumentParser(description="Calculate MD5 (or SHA256) checksums for all files in a directory.")
     parser.add_argument("directory", type=str, help="The path to the directory.")
     # logging. I usually run with -v
     parser.add_argument("--verbose", "-v", action='store_true', help="Turn on verbose logging.")
     parser.add_argument("--debug", "-d", action='store_true', help="Turn on debug logging.")
     # you probably don't want to actually set these
     parser.add_argument("--workers", "-w", type=int, default=5, help="Number of workers to use.")
-    parser.add_argument("--read-size", "-r", type=int, default=0, help="How big the file read chunks will be. Pass 0 to use os.stat to make a good guess.")
+    # sha256 goes through OpenSSL, which uses the CPU's SHA extensions when it has them
+    parser.add_argument("--algo", "-a", type=str, default="md5", choices=["md5", "sha256"], help="Checksum algorithm to use.")
+    parser.add_argument("--read-size", "-r", type=int, default=DEFAULT_READ_SIZE, help=f"How big the file read chunks will be. Defaults to {DEFAULT_READ_SIZE} bytes.")
     # These only apply to "create" (that is, not-verify)
-    parser.add_argument("--output-file", "-o", type=str, default=None, help="Output file name; will default to the <directory>.md5")
+    parser.add_argument("--output-file", "-o", type=str, default=None, help="Output file name; will default to the <directory>.md5 (or .sha256)")
     parser.add_argument("--include-hidden", "-s", action='store_true', help="Include hidden files and directories; they are excluded by default")
     parser.add_argument("--nodotslash", action='store_true', help="turn off the dot-slash ('./') before each file in the checksum output")
     # these only apply to "verify" (that is, not-create)
@@ -176,11 +446,7 @@ def main():
 
     read_size = args.read_size
     if read_size <= 0:
-        try:
-            read_size = os.stat(args.directory).st_blksize
-        except OSError:
-            read_size = 1024
-            logger.debug(f"Couldn't stat the target directory, using read size of {read_size}")
+        read_size = DEFAULT_READ_SIZE
     logger.debug(f"Using a read chunk size of {read_size}")
 
     there_was_an_error = False
@@ -192,19 +458,17 @@ def main():
         checksums = read_checksum_file(checksum_file)
         logger.info(f"Verifying {len(checksums)} checksums from file {checksum_file} against {directory}")
 
-        results = verify_checksums_multithread(checksums, directory, max_workers=args.workers, read_size=read_size, keep_going=args.keepgoing)
+        results = verify_checksums_multithread(checksums, directory, max_workers=args.workers, read_size=read_size, keep_going=args.keepgoing, algo=args.algo)
 
+        num_processed = 0
         for file_path, calculated_checksum, expected_checksum in results:
+            num_processed += 1
             if calculated_checksum != expected_checksum:
                 logger.error(f"Failed checksum for {file_path}, expected={expected_checksum}, calculated={calculated_checksum}")
                 there_was_an_error = True
 
-        if len(checksums) != len(results):
-            logger.warning(f"There are {len(checksums)} in the checksum file and we processed {len(results)} from {checksum_file}")
-
-        num_files_in_directory = sum(1 for _, _, files in os.walk(directory, followlinks=True) for f in files)
-        if num_files_in_directory != len(results):
-            logger.warning(f"There are {num_files_in_directory} under {directory} file and we processed {len(results)} from {checksum_file}")
+        if len(checksums) != num_processed:
+            logger.warning(f"There are {len(checksums)} in the checksum file and we processed {num_processed} from {checksum_file}")
 
         num_lines = len(checksums)
         the_file = checksum_file
@@ -220,14 +484,13 @@ def main():
 
         outfile_name = args.output_file
         if outfile_name is None:
-            outfile_name = os.path.split(os.path.abspath(directory))[1] + ".md5"
+            outfile_name = os.path.split(os.path.abspath(directory))[1] + "." + args.algo
 
-        logger.info(f"Writing MD5 checksums to {os.path.abspath(outfile_name)}")
+        logger.info(f"Writing {args.algo} checksums to {os.path.abspath(outfile_name)}")
 
         with open(outfile_name, 'w') as out:
-            calculate_checksums_multithread(directory, max_workers=args.workers, read_size=read_size, outfile=out, dotslash=dotslash, skip_hidden=skip_hidden)
+            num_lines = calculate_checksums_multithread(directory, max_workers=args.workers, read_size=read_size, outfile=out, dotslash=dotslash, skip_hidden=skip_hidden, algo=args.algo)
 
-        num_lines = sum(1 for _ in open(outfile_name))
         the_file = outfile_name
 
     delta = datetime.now().replace(microsecond=0) - start